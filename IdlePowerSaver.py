@@ -1,35 +1,109 @@
 #!/usr/bin/env python3
 
+import os
+import mmap
+import collections
+import glob
 import time
+import array
+import fcntl
+import select
+import signal
+import socket
+import struct
 import logging
 import threading
 import subprocess
-import psutil
 
 
 USB_INPUT_DEVICES = ['5:002:1', '5:002:2', '5:003:1', '5:004:1']
-USB_MONITOR_FILE = '/sys/kernel/debug/usb/usbmon/0u'
+USB_MONITOR_DEVICE = '/dev/usbmon0'
+USBMON_FETCH_BATCH = 64
+# Optional: pin the USB monitor thread to this core and/or run it under
+# SCHED_FIFO. Off by default; the idle threshold is minutes, not ms.
+USB_MONITOR_CPU = None
+USB_MONITOR_REALTIME = False
+USB_POLL_TIMEOUT = 1.0
+NETLINK_KOBJECT_UEVENT = 15
 MIN_IDLE_MINUTES = 15
+ENABLE_CPU_MONITORING = True
 LOW_CPU_MINUTES = 5
 LOW_CPU_THRESHOLD = 50
 LOW_PERF_GOVERNOR = 'powersave'
 HIGH_PERF_GOVERNOR = 'ondemand'
+PROC_STAT_FILE = '/proc/stat'
+SCALING_GOVERNOR_FILES = '/sys/devices/system/cpu/cpu*/cpufreq/scaling_governor'
+
+# usbmon binary API, see Documentation/usb/usbmon.rst
+_USBMON_PKT = struct.Struct('<QBBBBHbbqiiII8siiII')
+_USBMON_PREFIX = struct.Struct('<QBBBBH')
+_MFETCH = struct.Struct('PII')
+# Encoded with the asm-generic _IOC layout (direction in bits 30-31, 14-bit
+# size); powerpc, mips, sparc and alpha differ, so only x86 and arm are
+# supported
+_IOC_GENERIC_MACHINES = ('x86_64', 'i386', 'i486', 'i586', 'i686', 'aarch64')
+MON_IOCQ_RING_SIZE = (0x92 << 8) | 5
+MON_IOCX_MFETCH = (3 << 30) | (_MFETCH.size << 16) | (0x92 << 8) | 7
+USBMON_FILLER = ord('@')
+USB_ACTIVITY_LOG_INTERVAL = 60
+_XFER_TYPES = ('ISO', 'Interrupt', 'Control', 'Bulk')
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s',
                     datefmt='%Y-%m-%d %H:%M:%S')
+log = logging.getLogger(__name__)
 
 
 class IdlePowerSaver:
     def __init__(self):
-        self.last_seen_time = time.time()
-        self.active_governor = str
+        self.last_seen_time = time.monotonic()
+        self.last_usb_log_time = self.last_seen_time - USB_ACTIVITY_LOG_INTERVAL
+        self.active_governor = None
+        self._governor_paths = sorted(glob.glob(SCALING_GOVERNOR_FILES))
+        self._governor_missing_logged = False
         self.minimum_idle_time = 60 * MIN_IDLE_MINUTES
-        self.cpu_idle_time_required = 5 * LOW_CPU_MINUTES
-        self.cpu_check_interval = 60
+        self.cpu_idle_time_required = 60 * LOW_CPU_MINUTES
+        self.enable_cpu_monitoring = ENABLE_CPU_MONITORING
+        self.cpu_check_interval = 10
+        self.cpu_percentages = collections.deque(
+            maxlen=self.cpu_idle_time_required // self.cpu_check_interval)
+        self.cpu_sum = 0.0
+        self._cpu_lock = threading.Lock()
+        self._activity_event = threading.Event()
+        self.shutdown_flag = threading.Event()
+        self._monitor_all = False
+        self._monitored_devices = set()
+        self._monitored_endpoints = set()
+        self.parse_usb_input_devices()
+
+    def parse_usb_input_devices(self):
+        # 'bus:dev:ep' as printed by the text usbmon interface, 'bus:dev'
+        # for any endpoint, '0' for every device like usbmon's own bus 0
+        for device in USB_INPUT_DEVICES:
+            fields = device.split(':')
+            if device == '0':
+                self._monitor_all = True
+            elif (len(fields) in (2, 3) and
+                    all(field.isdigit() for field in fields)):
+                ids = tuple(int(field) for field in fields)
+                if len(ids) == 2:
+                    self._monitored_devices.add(ids)
+                else:
+                    self._monitored_endpoints.add(ids)
+            else:
+                raise ValueError(
+                    f"Invalid USB_INPUT_DEVICES entry {device!r}: expected "
+                    "'bus:dev:ep', 'bus:dev' or '0'")
+
+    def check_usbmon_support(self):
+        machine = os.uname().machine
+        if not (machine in _IOC_GENERIC_MACHINES or machine.startswith('arm')):
+            raise RuntimeError(
+                f"usbmon ioctl numbers are only defined for x86 and arm, "
+                f"not {machine}")
 
     def load_usbmon_module(self):
-        logging.info("Loading usbmon kernel module")
+        log.info("Loading usbmon kernel module")
         subprocess.run(["modprobe", "usbmon"], check=True)
 
     def disable_powersave(self):
@@ -41,53 +115,253 @@ class IdlePowerSaver:
             self.toggle_cpu_scaling_governor(LOW_PERF_GOVERNOR)
 
     def toggle_cpu_scaling_governor(self, governor_name):
-        logging.info(f"Enabling {governor_name} scaling governor")
-        command = f"echo {governor_name} | tee /sys/devices/system/cpu/cpu*/cpufreq/scaling_governor"
-        subprocess.run(command, shell=True, check=True,
-                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if not self._governor_paths:
+            # cpufreq driver may have been loaded after startup
+            self._governor_paths = sorted(glob.glob(SCALING_GOVERNOR_FILES))
+        if not self._governor_paths:
+            # Retried on every check; only report it once
+            if not self._governor_missing_logged:
+                log.error("Cannot enable %s scaling governor: no files "
+                          "match %s", governor_name, SCALING_GOVERNOR_FILES)
+                self._governor_missing_logged = True
+            return
+        log.info("Enabling %s scaling governor", governor_name)
+        # Like tee, write every CPU before reporting failures so one bad
+        # core doesn't leave the rest on the old governor
+        failures = []
+        for path in self._governor_paths:
+            try:
+                with open(path, 'w') as f:
+                    f.write(governor_name)
+            except OSError as e:
+                failures.append(f"{path}: {e}")
+        if failures:
+            self.active_governor = None
+            raise OSError(f"Could not enable {governor_name} scaling governor"
+                          f" on {len(failures)} of {len(self._governor_paths)}"
+                          f" CPUs: {'; '.join(failures)}")
         self.active_governor = governor_name
 
+    def prioritize_usb_thread(self):
+        # pid 0 refers to the calling thread
+        if USB_MONITOR_CPU is not None:
+            try:
+                os.sched_setaffinity(0, {USB_MONITOR_CPU})
+            except OSError as e:
+                log.warning("Could not pin USB monitor to CPU %d: %s",
+                            USB_MONITOR_CPU, e)
+        if USB_MONITOR_REALTIME:
+            try:
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(1))
+            except OSError as e:
+                log.warning("Could not set SCHED_FIFO for USB monitor: %s", e)
+
+    def open_uevent_socket(self):
+        # Kernel uevents announce USB plug/unplug, which usbmon only sees
+        # for devices already listed in USB_INPUT_DEVICES
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                                 NETLINK_KOBJECT_UEVENT)
+            sock.bind((0, 1))
+            sock.setblocking(False)
+        except OSError as e:
+            log.warning("Could not subscribe to kernel uevents: %s", e)
+            return None
+        return sock
+
+    def read_uevents(self, sock):
+        usb_event = False
+        while True:
+            try:
+                message = sock.recv(4096)
+            except BlockingIOError:
+                return usb_event
+            except OSError as e:
+                # ENOBUFS: messages were dropped and may have been USB
+                # events, so count it as activity
+                log.debug("Kernel uevent socket: %s", e)
+                return True
+            if b'\0SUBSYSTEM=usb\0' in message:
+                log.debug("USB uevent %s", message.split(b'\0', 1)[0])
+                usb_event = True
+
+    def drain_uevents(self, sock, current_time):
+        if self.read_uevents(sock):
+            self.last_seen_time = current_time
+            self._activity_event.set()
+
     def monitor_usb(self):
-        process = subprocess.Popen(
-            ['cat', USB_MONITOR_FILE], stdout=subprocess.PIPE, text=True)
+        self.prioritize_usb_thread()
+        # Map the kernel's usbmon ring and fetch events in batches: one
+        # ioctl returns up to USBMON_FETCH_BATCH event offsets and releases
+        # the batch consumed on the previous call. The fd is non-blocking,
+        # so an empty ring sends us to select() until the kernel has more.
+        fd = os.open(USB_MONITOR_DEVICE, os.O_RDONLY | os.O_NONBLOCK)
+        uevent_sock = self.open_uevent_socket()
+        watched = [fd] if uevent_sock is None else [fd, uevent_sock]
         try:
-            while True:
-                line = process.stdout.readline()
-                if not line:
-                    break
-                if any(device in line for device in USB_INPUT_DEVICES):
-                    self.last_seen_time = time.time()
+            ring_size = fcntl.ioctl(fd, MON_IOCQ_RING_SIZE)
+            ring = mmap.mmap(fd, ring_size, mmap.MAP_SHARED, mmap.PROT_READ)
+            offsets = array.array('I', [0] * USBMON_FETCH_BATCH)
+            offvec = offsets.buffer_info()[0]
+            request = bytearray(_MFETCH.size)
+            # Hot loop state as locals rather than global/attribute lookups
+            monitor_all = self._monitor_all
+            monitored_devices = self._monitored_devices
+            monitored_endpoints = self._monitored_endpoints
+            unpack_prefix = _USBMON_PREFIX.unpack_from
+            monotonic = time.monotonic
+            fetched = 0
+            last_uevent_drain = monotonic()
+            while not self.shutdown_flag.is_set():
+                _MFETCH.pack_into(request, 0, offvec, USBMON_FETCH_BATCH,
+                                  fetched)
+                try:
+                    fcntl.ioctl(fd, MON_IOCX_MFETCH, request)
+                except BlockingIOError:
+                    # The previous batch was flushed before the kernel
+                    # found the ring empty
+                    fetched = 0
+                    readable = select.select(watched, [], [],
+                                             USB_POLL_TIMEOUT)[0]
+                    if uevent_sock in readable:
+                        last_uevent_drain = monotonic()
+                        self.drain_uevents(uevent_sock, last_uevent_drain)
+                    continue
+                fetched = _MFETCH.unpack(request)[1]
+                # One clock read per batch is plenty against a
+                # MIN_IDLE_MINUTES threshold.
+                current_time = None
+                for offset in offsets[:fetched]:
+                    _, event_type, xfer_type, epnum, devnum, busnum = (
+                        unpack_prefix(ring, offset))
+                    if event_type == USBMON_FILLER:
+                        continue
+                    endpoint = epnum & 0x7f
+                    if not (monitor_all or
+                            (busnum, devnum, endpoint) in monitored_endpoints or
+                            (monitored_devices and
+                             (busnum, devnum) in monitored_devices)):
+                        continue
+                    if current_time is None:
+                        current_time = monotonic()
+                        self.last_seen_time = current_time
+                        self._activity_event.set()
+                    if (current_time - self.last_usb_log_time
+                            >= USB_ACTIVITY_LOG_INTERVAL and
+                            log.isEnabledFor(logging.DEBUG)):
+                        packet = _USBMON_PKT.unpack_from(ring, offset)
+                        log.debug("USB activity on %d:%03d:%d (%s %c, %d bytes)",
+                                  busnum, devnum, endpoint,
+                                  _XFER_TYPES[xfer_type], event_type,
+                                  packet[11])
+                        self.last_usb_log_time = current_time
+                # A busy ring never gets to select(), so drain uevents on a
+                # timer rather than with an extra recv() per batch
+                if uevent_sock is None:
+                    continue
+                if current_time is None:
+                    current_time = monotonic()
+                if current_time - last_uevent_drain >= USB_POLL_TIMEOUT:
+                    last_uevent_drain = current_time
+                    self.drain_uevents(uevent_sock, current_time)
         finally:
-            process.kill()
-
-    def check_cpu_usage(self):
-        utilization_records = []
-        end_time = time.time() + self.cpu_idle_time_required
-        while time.time() < end_time:
-            utilization = psutil.cpu_percent(interval=self.cpu_check_interval)
-            utilization_records.append(utilization)
-            if utilization > LOW_CPU_THRESHOLD:
-                logging.info(f"High CPU usage detected: {utilization}%")
-                return False
+            if uevent_sock is not None:
+                uevent_sock.close()
+            os.close(fd)
+
+    def run_usb_monitor(self):
+        try:
+            self.monitor_usb()
+        finally:
+            # Wake the main loop so it notices this thread has exited
+            self._activity_event.set()
+
+    def read_cpu_times(self):
+        # Aggregate "cpu" line: user nice system idle iowait irq softirq
+        # steal; guest time is already counted in user and nice
+        with open(PROC_STAT_FILE) as f:
+            fields = [int(value) for value in f.readline().split()[1:9]]
+        return sum(fields), fields[3] + fields[4]
+
+    def monitor_cpu(self):
+        # Rolling window of samples with a running sum, so the main loop
+        # never blocks on sampling and the average is a single division.
+        total, idle = self.read_cpu_times()
+        while not self.shutdown_flag.wait(self.cpu_check_interval):
+            last_total, last_idle = total, idle
+            total, idle = self.read_cpu_times()
+            total_delta = total - last_total
+            if not total_delta:
+                continue
+            cpu_percent = 100 * (total_delta - (idle - last_idle)) / total_delta
+            with self._cpu_lock:
+                if len(self.cpu_percentages) == self.cpu_percentages.maxlen:
+                    self.cpu_sum -= self.cpu_percentages[0]
+                self.cpu_percentages.append(cpu_percent)
+                self.cpu_sum += cpu_percent
+
+    def check_cpu_idle(self):
+        if not self.enable_cpu_monitoring:
+            return True
+        with self._cpu_lock:
+            samples = len(self.cpu_percentages)
+            cpu_sum = self.cpu_sum
+        if samples < self.cpu_percentages.maxlen:
+            return False
+        average = cpu_sum / samples
+        if average > LOW_CPU_THRESHOLD:
+            log.debug("High CPU usage detected: %.1f%%", average)
+            return False
         return True
 
+    def stop_monitoring(self, signum, frame):
+        # Runs in the main thread, possibly while it holds an Event's lock:
+        # take no locks here and let start_monitoring's finally clean up
+        raise SystemExit(0)
+
     def start_monitoring(self):
+        self.check_usbmon_support()
         self.load_usbmon_module()
         self.toggle_cpu_scaling_governor("ondemand")
+        signal.signal(signal.SIGTERM, self.stop_monitoring)
 
-        monitor_thread = threading.Thread(target=self.monitor_usb)
+        monitor_thread = threading.Thread(target=self.run_usb_monitor)
         monitor_thread.start()
+        if self.enable_cpu_monitoring:
+            threading.Thread(target=self.monitor_cpu, daemon=True).start()
 
         try:
             while True:
-                if (time.time() - self.last_seen_time > self.minimum_idle_time and
-                        self.check_cpu_usage()):
+                self._activity_event.clear()
+                # Without it last_seen_time stops moving and we would enter
+                # powersave and never leave; exit so systemd restarts us
+                if not monitor_thread.is_alive():
+                    raise RuntimeError("USB monitor thread exited")
+                idle_time = time.monotonic() - self.last_seen_time
+                if (idle_time > self.minimum_idle_time and
+                        self.check_cpu_idle()):
                     self.enable_powersave()
                 else:
                     self.disable_powersave()
-                time.sleep(1)
+                if self.active_governor == LOW_PERF_GOVERNOR:
+                    # Leave powersave as soon as USB activity is seen,
+                    # otherwise re-check CPU load as new samples arrive
+                    self._activity_event.wait(
+                        self.cpu_check_interval
+                        if self.enable_cpu_monitoring else None)
+                else:
+                    # Nothing can change before the idle deadline
+                    time.sleep(max(self.minimum_idle_time - idle_time,
+                                   self.cpu_check_interval))
         finally:
-            monitor_thread.join()
+            # The main thread only takes shutdown_flag's lock here, so a
+            # signal that interrupted _activity_event can't block this
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            log.info("Shutting down")
+            self.shutdown_flag.set()
+            monitor_thread.join(timeout=5)
+            self.disable_powersave()
 
 
 if __name__ == "__main__":